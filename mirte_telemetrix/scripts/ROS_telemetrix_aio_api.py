@@ -4,14 +4,25 @@ import os, os.path
 import sys
 import time
 import math
+import bisect
+import functools
 import rospy
 import signal
 import aiorospy
 import io
+from concurrent.futures import ThreadPoolExecutor
 from inspect import signature
+from serial import SerialException
 from tmx_pico_aio import tmx_pico_aio
 from telemetrix_aio import telemetrix_aio
 
+# uvloop is optional, but its event loop has a lot less overhead
+# for the many small telemetrix callbacks
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 # Import the right Telemetrix AIO
 devices = rospy.get_param("/mirte/device")
@@ -20,21 +31,38 @@ devices = rospy.get_param("/mirte/device")
 # Until we update our own fork of TelemtrixAIO to the renamed pwm calls
 # we need to add a simple wrapper
 async def set_pin_mode_analog_output(board, pin):
-    if board_mapping.get_mcu() == "pico":
+    if IS_PICO:
         await board.set_pin_mode_pwm_output(pin)
     else:
         await board.set_pin_mode_analog_output(pin)
 
 
 async def analog_write(board, pin, value):
-    if board_mapping.get_mcu() == "pico":
+    if IS_PICO:
         await board.pwm_write(pin, value)
     else:
         await board.analog_write(pin, value)
 
 
+# Setting the scan delay fails when the pico is not ready yet. Without
+# it the analog inputs are scanned as fast as possible, so retry a few
+# times before giving up.
+async def set_scan_delay(board, delay_ms):
+    attempts = 3
+    for attempt in range(attempts):
+        try:
+            await board.set_scan_delay(delay_ms)
+            return
+        except SerialException as e:
+            error = e
+            # Only back off when there is another attempt
+            if attempt < attempts - 1:
+                await asyncio.sleep(0.05 * 2**attempt)
+    rospy.logerr("Failed to set the scan delay: %s", error)
+
+
 # Import ROS message types
-from std_msgs.msg import Header, Int32
+from std_msgs.msg import Int32
 from sensor_msgs.msg import Range
 from mirte_msgs.msg import *
 
@@ -48,8 +76,22 @@ from PIL import Image, ImageDraw, ImageFont
 
 # Currently loading the PIL default font, which is
 # monospace, so works with python textwrap
+# which also means all lines have the same height
 font = ImageFont.load_default()
 
+
+def get_font_height(line_font):
+    # getsize was removed in Pillow 10, older versions lack getbbox.
+    # Use the bottom measured from the origin of a string with a
+    # descender, so the ascender offset and descenders are included.
+    try:
+        return line_font.getbbox("Mg")[3]
+    except AttributeError:
+        return line_font.getsize("Mg")[1]
+
+
+FONT_HEIGHT = get_font_height(font)
+
 from adafruit_ssd1306 import _SSD1306
 
 
@@ -59,40 +101,47 @@ import mappings.pico
 import mappings.blackpill_f103c8
 import mappings.pcb
 
-board_mapping = mappings.default
+# Board mappings for the boards that can be used on a breadboard
+BOARD_MAPPINGS = {
+    "blackpill_f103c8": mappings.blackpill_f103c8,
+    "nanoatmega328": mappings.nanoatmega328,
+    "nanoatmega328new": mappings.nanoatmega328,
+    "uno": mappings.nanoatmega328,  # uno has the same pinout
+    "pico": mappings.pico,
+}
+
+
+def select_board_mapping(mirte):
+    if mirte["type"] == "pcb":
+        if "version" in mirte:
+            if "board" in mirte:
+                mappings.pcb.set_version(mirte["version"], mirte["board"])
+            else:
+                mappings.pcb.set_version(mirte["version"])
+        return mappings.pcb
 
-devices = rospy.get_param("/mirte/device")
+    if mirte["type"] == "breadboard" and "board" in mirte:
+        return BOARD_MAPPINGS.get(mirte["board"], mappings.default)
 
-if devices["mirte"]["type"] == "pcb":
-    board_mapping = mappings.pcb
-    if "version" in devices["mirte"]:
-        if "board" in devices["mirte"]:
-            board_mapping.set_version(
-                devices["mirte"]["version"], devices["mirte"]["board"]
-            )
-        else:
-            board_mapping.set_version(devices["mirte"]["version"])
-
-if devices["mirte"]["type"] == "breadboard":
-    if "board" in devices["mirte"]:
-        if devices["mirte"]["board"] == "blackpill_f103c8":
-            board_mapping = mappings.blackpill_f103c8
-        elif (
-            "nanoatmega328"
-            in devices["mirte"][
-                "board"
-            ]  # will trigger for nanoatmega328new and nanoatmega328
-            or devices["mirte"]["board"] == "uno"  # uno has the same pinout
-        ):
-            board_mapping = mappings.nanoatmega328
-        elif devices["mirte"]["board"] == "pico":
-            board_mapping = mappings.pico
-        else:
-            board_mapping = mappings.default
+    return mappings.default
+
+
+board_mapping = select_board_mapping(devices["mirte"])
+
+# These only depend on the selected board, so look them up once
+MCU = board_mapping.get_mcu()
+IS_PICO = MCU == "pico"
+ADC_OFFSET = board_mapping.get_analog_offset()
+ADC_BITS = board_mapping.get_adc_bits()
+MAX_PWM = board_mapping.get_max_pwm_value()
+
+# PWM values for motor speeds of 0-100%
+PWM_LUT = tuple(speed * MAX_PWM // 100 for speed in range(101))
 
 
 def get_pin_numbers(component):
-    devices = rospy.get_param("/mirte/device")
+    # Use the device tree fetched at startup instead of querying the
+    # parameter server again for every component
     device = devices[component["device"]]
     pins = {}
     if "connector" in component:
@@ -111,10 +160,26 @@ def get_pin_numbers(component):
 
 # Abstract Sensor class
 class SensorMonitor:
+    # The attributes are accessed in every sensor callback, so use
+    # slots instead of a __dict__ for them
+    __slots__ = (
+        "board",
+        "pins",
+        "publisher",
+        "publish_msg",
+        "max_freq",
+        "differential",
+        "loop",
+        "publish_period",
+        "last_publish_time",
+        "last_publish_value",
+    )
+
     def __init__(self, board, sensor, publisher):
         self.board = board
         self.pins = get_pin_numbers(sensor)
         self.publisher = publisher
+        self.publish_msg = publisher.publish
         self.max_freq = 10
         if "max_frequency" in sensor:
             self.max_freq = sensor["max_frequency"]
@@ -122,6 +187,10 @@ class SensorMonitor:
         if "differential" in sensor:
             self.differential = sensor["differential"]
         self.loop = asyncio.get_event_loop()
+        # Minimal time between two published messages in ns
+        self.publish_period = 0
+        if self.max_freq > 0:
+            self.publish_period = 10**9 // self.max_freq
         self.last_publish_time = -1
         self.last_publish_value = {}
         rospy.loginfo(
@@ -131,107 +200,127 @@ class SensorMonitor:
             self.differential,
         )
 
-    def get_header(self):
-        header = Header()
-        header.stamp = rospy.Time.now()
-        return header
-
-    # NOTE: although there are no async functions in this
-    # the function needs to be async since it is called
-    # inside a callback of an awaited part of telemetrix
-    async def publish_imp(self, data):
-        self.publisher.publish(data)
+    # Publishing itself is synchronous, so there is no need to
+    # create a coroutine for every message.
+    def publish_imp(self, data):
+        self.publish_msg(data)
         self.last_publish_value = data
 
-    async def publish(self, data):
+    def publish(self, data):
         if self.max_freq == -1:
-            await self.publish_imp(data)
+            self.publish_imp(data)
         else:
-            now_millis = int(round(time.time() * 1000))
+            now = time.monotonic_ns()
 
             # always publish the first message (TODO: and maybe messages that took too long 2x 1/freq?)
             if self.last_publish_time == -1:
-                await self.publish_imp(data)
-                self.last_publish_time = now_millis
+                self.publish_imp(data)
+                self.last_publish_time = now
 
             # from then on publish if needed based on max_freq
-            if now_millis - self.last_publish_time >= 1000.0 / self.max_freq:
-                await self.publish_imp(data)
+            elif now - self.last_publish_time >= self.publish_period:
+                self.publish_imp(data)
                 self.last_publish_time += (
-                    1000.0 / self.max_freq
-                )  # Note: this should not be set to now_millis. This is due to Nyquist.
+                    self.publish_period
+                )  # Note: this should not be set to now. This is due to Nyquist.
 
 
 class KeypadMonitor(SensorMonitor):
+    __slots__ = (
+        "last_index",
+        "stable_samples",
+        "debounce_samples",
+        "last_debounced_key",
+        "pressed_publisher",
+        "msg",
+        "pressed_msg",
+        "key_thresholds",
+        "keys",
+    )
+
     def __init__(self, board, sensor):
         pub = rospy.Publisher("/mirte/keypad/" + sensor["name"], Keypad, queue_size=1)
         srv = rospy.Service(
             "/mirte/get_keypad_" + sensor["name"], GetKeypad, self.get_data
         )
         super().__init__(board, sensor, pub)
-        self.last_debounce_time = 0
-        self.last_key = ""
         self.last_debounced_key = ""
         self.pressed_publisher = rospy.Publisher(
             "/mirte/keypad/" + sensor["name"] + "_pressed", Keypad, queue_size=1
         )
         self.last_publish_value = Keypad()
+        self.msg = Keypad()
+        self.pressed_msg = Keypad()
+
+        # The keys are determined by the ADC value being below these
+        # thresholds. TODO: these values were found on a 12 bits adc, and
+        # added a scaling for the actual bits used. We could calculate
+        # this with the R values used.
+        adc_scale = 2**ADC_BITS / 4096
+        self.key_thresholds = [value * adc_scale for value in [70, 230, 410, 620, 880]]
+        self.keys = ["left", "up", "down", "right", "enter", ""]
+
+        # For debouncing count the samples since the key last changed.
+        # The analog input is scanned at max_freq, so the 0.1s debounce
+        # time is converted to samples. When the scanning is not limited
+        # the rate is unknown, so just use 4 samples.
+        self.last_index = -1
+        self.stable_samples = 0
+        self.debounce_samples = 4
+        if self.max_freq > 0:
+            self.debounce_samples = int(0.1 * self.max_freq) + 1
 
     def get_data(self, req):
         return GetKeypadResponse(self.last_publish_value.key)
 
     async def start(self):
         await self.board.set_pin_mode_analog_input(
-            self.pins["pin"] - board_mapping.get_analog_offset(),
+            self.pins["pin"] - ADC_OFFSET,
             differential=self.differential,
             callback=self.publish_data,
         )
 
-    async def publish_data(self, data):
+    # NOTE: the publish_data callbacks of the sensors need to be
+    # async since they are called inside an awaited part of
+    # telemetrix. They bind rospy.Time.now as a default argument,
+    # which makes it a local lookup instead of a global and an
+    # attribute lookup for every sample.
+    async def publish_data(self, data, _now=rospy.Time.now):
         # Determine the key that is pressed
-        # TODO: these values were found on a 12 bits adc, and
-        # added a scaling for the actual bits used. We could
-        # calculate this with the R values used.
-        key = ""
-        if data[2] < 70 / 4096 * (2 ** board_mapping.get_adc_bits()):
-            key = "left"
-        elif data[2] < 230 / 4096 * (2 ** board_mapping.get_adc_bits()):
-            key = "up"
-        elif data[2] < 410 / 4096 * (2 ** board_mapping.get_adc_bits()):
-            key = "down"
-        elif data[2] < 620 / 4096 * (2 ** board_mapping.get_adc_bits()):
-            key = "right"
-        elif data[2] < 880 / 4096 * (2 ** board_mapping.get_adc_bits()):
-            key = "enter"
-
-        # Do some debouncing
-        if self.last_key is not key:
-            self.last_debounce_time = data[3]
+        index = bisect.bisect_right(self.key_thresholds, data[2])
+
+        # Do some debouncing, only accept a key when it did not
+        # change for the debounce time
+        if index != self.last_index:
+            self.last_index = index
+            self.stable_samples = 0
+        elif self.stable_samples < self.debounce_samples:
+            self.stable_samples += 1
 
         debounced_key = ""
-        if data[3] - self.last_debounce_time > 0.1:
-            debounced_key = key
+        if self.stable_samples >= self.debounce_samples:
+            debounced_key = self.keys[index]
 
         # Publish the last debounced key
-        keypad = Keypad()
-        keypad.header = self.get_header()
-        keypad.key = debounced_key
-        await self.publish(keypad)
+        stamp = _now()
+        self.msg.header.stamp = stamp
+        self.msg.key = debounced_key
+        self.publish(self.msg)
 
         # check if we need to send a pressed message
         if (self.last_debounced_key != "") and (
             self.last_debounced_key is not debounced_key
         ):
-            pressed = Keypad()
-            pressed.header = self.get_header()
-            pressed.key = self.last_debounced_key
-            self.pressed_publisher.publish(pressed)
+            self.pressed_msg.header.stamp = stamp
+            self.pressed_msg.key = self.last_debounced_key
+            self.pressed_publisher.publish(self.pressed_msg)
 
-        self.last_key = key
         self.last_debounced_key = debounced_key
 
 
 class DistanceSensorMonitor(SensorMonitor):
+    __slots__ = ("msg",)
+
     def __init__(self, board, sensor):
         pub = rospy.Publisher(
             "/mirte/distance/" + sensor["name"], Range, queue_size=1, latch=True
@@ -242,6 +331,14 @@ class DistanceSensorMonitor(SensorMonitor):
         super().__init__(board, sensor, pub)
         self.last_publish_value = Range()
 
+        # The message is reused for every measurement, rospy serializes
+        # it while publishing so only the changing fields are updated.
+        self.msg = Range()
+        self.msg.radiation_type = Range.ULTRASOUND
+        self.msg.field_of_view = math.pi * 5
+        self.msg.min_range = 0.02
+        self.msg.max_range = 1.5
+
     def get_data(self, req):
         return GetDistanceResponse(self.last_publish_value.range)
 
@@ -251,22 +348,15 @@ class DistanceSensorMonitor(SensorMonitor):
             self.pins["trigger"], self.pins["echo"], self.publish_data
         )
 
-    async def publish_data(self, data):
-        # Although the initialization of this Range message
-        # including some of the values could be placed in the
-        # constructor for efficiency reasons. This does
-        # for some reason not work though.
-        range = Range()
-        range.radiation_type = range.ULTRASOUND
-        range.field_of_view = math.pi * 5
-        range.min_range = 0.02
-        range.max_range = 1.5
-        range.header = self.get_header()
-        range.range = data[2]
-        await self.publish(range)
+    async def publish_data(self, data, _now=rospy.Time.now):
+        self.msg.header.stamp = _now()
+        self.msg.range = data[2]
+        self.publish(self.msg)
 
 
 class DigitalIntensitySensorMonitor(SensorMonitor):
+    __slots__ = ("msg",)
+
     def __init__(self, board, sensor):
         pub = rospy.Publisher(
             "/mirte/intensity/" + sensor["name"] + "_digital",
@@ -281,6 +371,7 @@ class DigitalIntensitySensorMonitor(SensorMonitor):
         )
         super().__init__(board, sensor, pub)
         self.last_publish_value = IntensityDigital()
+        self.msg = IntensityDigital()
 
     def get_data(self, req):
         return GetIntensityDigitalResponse(self.last_publish_value.value)
@@ -290,14 +381,15 @@ class DigitalIntensitySensorMonitor(SensorMonitor):
             self.pins["digital"], callback=self.publish_data
         )
 
-    async def publish_data(self, data):
-        intensity = IntensityDigital()
-        intensity.header = self.get_header()
-        intensity.value = bool(data[2])
-        await self.publish(intensity)
+    async def publish_data(self, data, _now=rospy.Time.now):
+        self.msg.header.stamp = _now()
+        self.msg.value = bool(data[2])
+        self.publish(self.msg)
 
 
 class AnalogIntensitySensorMonitor(SensorMonitor):
+    __slots__ = ("msg",)
+
     def __init__(self, board, sensor):
         pub = rospy.Publisher(
             "/mirte/intensity/" + sensor["name"], Intensity, queue_size=100
@@ -307,25 +399,27 @@ class AnalogIntensitySensorMonitor(SensorMonitor):
         )
         super().__init__(board, sensor, pub)
         self.last_publish_value = Intensity()
+        self.msg = Intensity()
 
     def get_data(self, req):
         return GetIntensityResponse(self.last_publish_value.value)
 
     async def start(self):
         await self.board.set_pin_mode_analog_input(
-            self.pins["analog"] - board_mapping.get_analog_offset(),
+            self.pins["analog"] - ADC_OFFSET,
             differential=self.differential,
             callback=self.publish_data,
         )
 
-    async def publish_data(self, data):
-        intensity = Intensity()
-        intensity.header = self.get_header()
-        intensity.value = data[2]
-        await self.publish(intensity)
+    async def publish_data(self, data, _now=rospy.Time.now):
+        self.msg.header.stamp = _now()
+        self.msg.value = data[2]
+        self.publish(self.msg)
 
 
 class EncoderSensorMonitor(SensorMonitor):
+    __slots__ = ("speed_pub", "ticks_per_wheel", "msg", "speed_msg", "speed_count")
+
     def __init__(self, board, sensor):
         pub = rospy.Publisher(
             "/mirte/encoder/" + sensor["name"], Encoder, queue_size=1, latch=True
@@ -342,13 +436,15 @@ class EncoderSensorMonitor(SensorMonitor):
             self.ticks_per_wheel = sensor["ticks_per_wheel"]
         self.max_freq = -1
         self.last_publish_value = Encoder()
+        self.msg = Encoder()
+        self.speed_msg = Encoder()
         self.speed_count = 0
 
     def get_data(self, req):
         return GetEncoderResponse(self.last_publish_value.value)
 
     async def start(self):
-        if board_mapping.get_mcu() == "pico":
+        if IS_PICO:
             await self.board.set_pin_mode_encoder(
                 self.pins["pin"], 0, self.publish_data, False
             )
@@ -359,21 +455,29 @@ class EncoderSensorMonitor(SensorMonitor):
         rospy.Timer(rospy.Duration(1.0 / 10.0), self.publish_speed_data)
 
     def publish_speed_data(self, event=None):
-        encoder = Encoder()
-        encoder.header = self.get_header()
-        encoder.value = self.speed_count
+        self.speed_msg.header.stamp = rospy.Time.now()
+        self.speed_msg.value = self.speed_count
         self.speed_count = 0
-        self.speed_pub.publish(encoder)
+        self.speed_pub.publish(self.speed_msg)
 
-    async def publish_data(self, data):
+    async def publish_data(self, data, _now=rospy.Time.now):
         self.speed_count = self.speed_count + 1
-        encoder = Encoder()
-        encoder.header = self.get_header()
-        encoder.value = data[2]
-        await self.publish(encoder)
+        self.msg.header.stamp = _now()
+        self.msg.value = data[2]
+        self.publish(self.msg)
+
+
+# Monitors for the sensor types that have one monitor per sensor
+SENSOR_MONITORS = {
+    "distance": DistanceSensorMonitor,
+    "keypad": KeypadMonitor,
+    "encoder": EncoderSensorMonitor,
+}
 
 
 class Servo:
+    __slots__ = ("board", "pins", "name", "min_pulse", "max_pulse", "loop")
+
     def __init__(self, board, servo_obj):
         self.board = board
         self.pins = get_pin_numbers(servo_obj)
@@ -384,6 +488,7 @@ class Servo:
         self.max_pulse = 2400
         if "max_pulse" in servo_obj:
             self.max_pulse = servo_obj["max_pulse"]
+        self.loop = asyncio.get_event_loop()
 
     async def stop(self):
         await board.detach_servo(self.pins["pin"])
@@ -397,37 +502,55 @@ class Servo:
         )
 
     def set_servo_angle_service(self, req):
-        asyncio.run(board.servo_write(self.pins["pin"], req.angle))
+        # the ros service is started on a different thread than the asyncio loop
+        future = asyncio.run_coroutine_threadsafe(
+            self.board.servo_write(self.pins["pin"], req.angle), self.loop
+        )
+        future.result()  # wait for it to be done
         return SetServoAngleResponse(True)
 
 
 class Motor:
-    def __init__(self, board, motor_obj):
+    __slots__ = ("board", "pins", "name", "prev_motor_speed", "initialized", "loop")
+
+    def __init__(self, board, motor_obj, loop):
         self.board = board
+        self.loop = loop
         self.pins = get_pin_numbers(motor_obj)
         self.name = motor_obj["name"]
         self.prev_motor_speed = 0
         self.initialized = False
 
+    # The service and subscriber are handled on the asyncio loop itself
+    # by aiorospy, so the speed changes do not need to be handed over
+    # from the rospy threads.
     async def start(self):
-        server = rospy.Service(
-            "/mirte/set_" + self.name + "_speed",
-            SetMotorSpeed,
-            self.set_motor_speed_service,
-        )
-        sub = rospy.Subscriber(
-            "/mirte/motor_" + self.name + "_speed", Int32, self.callback
+        service_name = "/mirte/set_" + self.name + "_speed"
+        server = aiorospy.AsyncService(
+            service_name, SetMotorSpeed, self.set_motor_speed_service
         )
+        start_server(self.loop, server.start(), service_name)
+
+        topic = "/mirte/motor_" + self.name + "_speed"
+        sub = aiorospy.AsyncSubscriber(topic, Int32)
+        start_server(self.loop, self.handle_speed_messages(sub), topic)
 
-    def callback(self, data):
-        asyncio.run(self.set_speed(data.data))
+    async def handle_speed_messages(self, sub):
+        async for data in sub.subscribe():
+            # A failing speed write should not stop handling the next ones
+            try:
+                await self.set_speed(data.data)
+            except Exception as e:
+                rospy.logerr("Failed to set the speed of %s: %r", self.name, e)
 
-    def set_motor_speed_service(self, req):
-        asyncio.run(self.set_speed(req.speed))
+    async def set_motor_speed_service(self, req):
+        await self.set_speed(req.speed)
         return SetMotorSpeedResponse(True)
 
 
 class PPMotor(Motor):
+    __slots__ = ()
+
     # Ideally one would initialize the pins in the constructor. But
     # since some mcu's have some voltage on pins when they are not
     # initialized yet icw some motor controllers that use the
@@ -458,7 +581,7 @@ class PPMotor(Motor):
                 await analog_write(
                     self.board,
                     self.pins["p1"],
-                    int(min(speed, 100) / 100.0 * board_mapping.get_max_pwm_value()),
+                    PWM_LUT[min(speed, 100)],
                 )
             elif speed < 0:
                 await self.init_motors(speed)
@@ -466,12 +589,14 @@ class PPMotor(Motor):
                 await analog_write(
                     self.board,
                     self.pins["p2"],
-                    int(min(-speed, 100) / 100.0 * board_mapping.get_max_pwm_value()),
+                    PWM_LUT[min(-speed, 100)],
                 )
             self.prev_motor_speed = speed
 
 
 class DPMotor(Motor):
+    __slots__ = ()
+
     # Ideally one would initialize the pins in the constructor. But
     # since some mcu's have some voltage on pins when they are not
     # initialized yet icw some motor controllers that use the
@@ -502,7 +627,7 @@ class DPMotor(Motor):
                 await analog_write(
                     self.board,
                     self.pins["p1"],
-                    int(min(speed, 100) / 100.0 * board_mapping.get_max_pwm_value()),
+                    PWM_LUT[min(speed, 100)],
                 )
             elif speed < 0:
                 await self.init_motors(speed)
@@ -510,17 +635,14 @@ class DPMotor(Motor):
                 await analog_write(
                     self.board,
                     self.pins["p1"],
-                    int(
-                        board_mapping.get_max_pwm_value()
-                        - min(abs(speed), 100)
-                        / 100.0
-                        * board_mapping.get_max_pwm_value()
-                    ),
+                    MAX_PWM - PWM_LUT[min(abs(speed), 100)],
                 )
             self.prev_motor_speed = speed
 
 
 class DDPMotor(Motor):
+    __slots__ = ()
+
     async def init_motors(self):
         if not self.initialized:
             await set_pin_mode_analog_output(self.board, self.pins["p1"])
@@ -539,7 +661,7 @@ class DDPMotor(Motor):
                 await analog_write(
                     self.board,
                     self.pins["p1"],
-                    int(min(speed, 100) / 100.0 * board_mapping.get_max_pwm_value()),
+                    PWM_LUT[min(speed, 100)],
                 )
                 await self.board.digital_write(self.pins["d2"], 1)
             elif speed < 0:
@@ -548,14 +670,32 @@ class DDPMotor(Motor):
                 await analog_write(
                     self.board,
                     self.pins["p1"],
-                    int(
-                        min(abs(speed), 100) / 100.0 * board_mapping.get_max_pwm_value()
-                    ),
+                    PWM_LUT[min(abs(speed), 100)],
                 )
                 await self.board.digital_write(self.pins["d1"], 1)
             self.prev_motor_speed = speed
 
 
+# Motor classes for each motor interface type
+MOTOR_CLASSES = {"ddp": DDPMotor, "dp": DPMotor, "pp": PPMotor}
+
+
+# Images and animation frames are loaded from disk and converted
+# only once, showing them again will use the cached version.
+@functools.lru_cache(maxsize=128)
+def load_image(file):
+    image_file = Image.open(file)  # open color image
+    return image_file.convert("1", dither=Image.NONE)
+
+
+# Loading images blocks on file I/O, so this is done on a separate
+# thread to not stall the sensor callbacks on the asyncio loop.
+image_executor = ThreadPoolExecutor(1, thread_name_prefix="oled-img")
+
+# Number of frames per animation, counted the first time it is shown
+animation_lengths = {}
+
+
 # Extended adafruit _SSD1306
 class Oled(_SSD1306):
     def __init__(
@@ -580,6 +720,10 @@ class Oled(_SSD1306):
         self.init_awaits = []
         self.write_commands = []
 
+        # Image to render text on, reused for every text request
+        self.text_image = Image.new("1", (width, height))
+        self.text_draw = ImageDraw.Draw(self.text_image)
+
         # Add an extra byte to the data buffer to hold an I2C data/command byte
         # to use hardware-compatible I2C transactions.  A memoryview of the
         # buffer is used to mask this byte from the framebuffer operations
@@ -588,7 +732,7 @@ class Oled(_SSD1306):
         self.buffer = bytearray(((height // 8) * width) + 1)
         # self.buffer = bytearray(16)
         # self.buffer[0] = 0x40  # Set first byte of data buffer to Co=0, D/C=1
-        if board_mapping.get_mcu() == "pico":
+        if IS_PICO:
             if "connector" in oled_obj:
                 pins = board_mapping.connector_to_pins(oled_obj["connector"])
             else:
@@ -639,19 +783,15 @@ class Oled(_SSD1306):
     async def set_oled_image_service_async(self, req):
         if req.type == "text":
             text = req.value.replace("\\n", "\n")
-            image = Image.new("1", (128, 64))
-            draw = ImageDraw.Draw(image)
+            self.text_draw.rectangle((0, 0, self.width, self.height), fill=0)
             split_text = text.splitlines()
             lines = []
             for i in split_text:
                 lines.extend(textwrap.wrap(i, width=20))
 
-            y_text = 1
-            for line in lines:
-                width, height = font.getsize(line)
-                draw.text((1, y_text), line, font=font, fill=255)
-                y_text += height
-            self.image(image)
+            for i, line in enumerate(lines):
+                self.text_draw.text((1, 1 + i * FONT_HEIGHT), line, font=font, fill=255)
+            self.image(self.text_image)
             await self.show_async()
         if req.type == "image":
             await self.show_png(
@@ -662,14 +802,12 @@ class Oled(_SSD1306):
             folder = (
                 "/usr/local/src/mirte/mirte-oled-images/animations/" + req.value + "/"
             )
-            number_of_images = len(
-                [
-                    name
-                    for name in os.listdir(folder)
-                    if os.path.isfile(os.path.join(folder, name))
-                ]
-            )
-            for i in range(number_of_images):
+            if req.value not in animation_lengths:
+                with os.scandir(folder) as entries:
+                    animation_lengths[req.value] = sum(
+                        1 for entry in entries if entry.is_file()
+                    )
+            for i in range(animation_lengths[req.value]):
                 await self.show_png(folder + req.value + "_" + str(i) + ".png")
 
     def set_oled_image_service(self, req):
@@ -713,12 +851,15 @@ class Oled(_SSD1306):
         self.temp[1] = cmd
         self.write_commands.append([0x80, cmd])
 
-    async def write_cmd_async(self, cmd):
+    async def write_cmds_async(self, cmds):
         if self.failed:
             return
-        self.temp[0] = 0x80
-        self.temp[1] = cmd
-        out = await self.board.i2c_write(60, self.temp, i2c_port=self.i2c_port)
+        # Send all commands in a single i2c message, each prefixed
+        # with a control byte (Co=1, D/C=0)
+        buf = bytearray(2 * len(cmds))
+        buf[0::2] = b"\x80" * len(cmds)
+        buf[1::2] = bytes(cmds)
+        out = await self.board.i2c_write(60, buf, i2c_port=self.i2c_port)
         if out is None:
             await asyncio.sleep(0.05)
         if out == False:
@@ -740,12 +881,16 @@ class Oled(_SSD1306):
             xpos1 += 28
 
         try:
-            await self.write_cmd_async(0x21)  # SET_COL_ADDR)
-            await self.write_cmd_async(xpos0)
-            await self.write_cmd_async(xpos1)
-            await self.write_cmd_async(0x22)  # SET_PAGE_ADDR)
-            await self.write_cmd_async(0)
-            await self.write_cmd_async(self.pages - 1)
+            await self.write_cmds_async(
+                [
+                    0x21,  # SET_COL_ADDR
+                    xpos0,
+                    xpos1,
+                    0x22,  # SET_PAGE_ADDR
+                    0,
+                    self.pages - 1,
+                ]
+            )
             await self.write_framebuf_async()
         except Exception as e:
             print(e)
@@ -754,18 +899,24 @@ class Oled(_SSD1306):
         if self.failed:
             return
 
-        async def task(self, i):
-            buf = self.buffer[i * 16 : (i + 1) * 16 + 1]
-            buf[0] = 0x40
+        # Telemetrix can not forward the whole frame in a single i2c
+        # message (the mcu command buffer is too small), so send it in
+        # chunks of 16 bytes prefixed with the data control byte. Stop at
+        # the first failed chunk instead of sending the rest of the frame.
+        # The chunk buffer is reused, it is copied by telemetrix when
+        # building the command.
+        buf = bytearray(17)
+        buf[0] = 0x40
+        framebuf = memoryview(self.buffer)
+        for i in range(64):
+            buf[1:] = framebuf[i * 16 + 1 : (i + 1) * 16 + 1]
             out = await self.board.i2c_write(60, buf, i2c_port=self.i2c_port)
             if out is None:
                 await asyncio.sleep(0.05)
             if out == False:
                 print("failed wrcmd")
                 self.failed = True
-
-        for i in range(64):
-            await task(self, i)
+                return
 
     def write_framebuf(self):
         for i in range(64):
@@ -774,18 +925,20 @@ class Oled(_SSD1306):
             self.write_commands.append(buf)
 
     async def show_png(self, file):
-        image_file = Image.open(file)  # open color image
-        image_file = image_file.convert("1", dither=Image.NONE)
+        image_file = await self.loop.run_in_executor(image_executor, load_image, file)
         self.image(image_file)
         await self.show_async()
 
 
+# Pin of the led, set when the led is initialized in actuators()
+led_pin = None
+
+
 async def handle_set_led_value(req):
-    led = rospy.get_param("/mirte/led")
     await analog_write(
         board,
-        get_pin_numbers(led)["pin"],
-        int(min(req.value, 100) / 100.0 * board_mapping.get_max_pwm_value()),
+        led_pin,
+        min(req.value, 100) * MAX_PWM // 100,
     )
     return SetLEDValueResponse(True)
 
@@ -797,6 +950,8 @@ async def handle_set_led_value(req):
 # the values into the member variable.
 
 pin_values = {}
+# Events that are set once the first value of a pin is received
+pin_events = {}
 
 
 # TODO: and this one probably needs to keep track of
@@ -806,12 +961,13 @@ async def data_callback(data):
     global pin_values
     pin_number = data[1]
     if data[0] == 3:
-        pin_number += board_mapping.get_analog_offset()
+        pin_number += ADC_OFFSET
     pin_values[pin_number] = data[2]
+    if pin_number in pin_events:
+        pin_events[pin_number].set()
 
 
-def handle_get_pin_value(req):
-    global pin_values
+async def handle_get_pin_value(req):
     # Map pin to the pin map if it is in there, or to
     # an int if raw pin number
     try:
@@ -820,29 +976,31 @@ def handle_get_pin_value(req):
         pin = int(req.pin)
 
     if not pin in pin_values:
+        if not pin in pin_events:
+            pin_events[pin] = asyncio.Event()
         if req.type == "analog":
-            asyncio.run(
-                board.set_pin_mode_analog_input(
-                    pin - board_mapping.get_analog_offset(), callback=data_callback
-                )
+            await board.set_pin_mode_analog_input(
+                pin - ADC_OFFSET, callback=data_callback
             )
         if req.type == "digital":
-            asyncio.run(board.set_pin_mode_digital_input(pin, callback=data_callback))
-
-    # timeout after 5s, don't keep waiting on something that will never happen.
-    start_time = time.time()
-    while not pin in pin_values and time.time() - start_time < 5.0:
-        time.sleep(0.001)
-    if pin in pin_values:
-        value = pin_values[pin]
-    else:
-        value = -1  # device did not report back, so return error value.
+            await board.set_pin_mode_digital_input(pin, callback=data_callback)
+
+        # timeout after 5s, don't keep waiting on something that will never happen.
+        try:
+            await asyncio.wait_for(pin_events[pin].wait(), 5.0)
+        except asyncio.TimeoutError:
+            # device did not report back, so return error value.
+            return GetPinValueResponse(-1)
+
+    return GetPinValueResponse(pin_values[pin])
+
 
-    return GetPinValueResponse(value)
+# The success response carries no state, so share one instance
+SET_PIN_VALUE_OK = SetPinValueResponse(True)
 
 
 # TODO: check on existing pin configuration?
-def handle_set_pin_value(req):
+async def handle_set_pin_value(req):
     # Map pin to the pin map if it is in there, or to
     # an int if raw pin number
     try:
@@ -854,24 +1012,24 @@ def handle_set_pin_value(req):
         # This should be a PWM capable pin. Therefore we do not need to
         # account for the board_mapping.analog_offset. We do need to account for the
         # max pwm_value though.
-        capped_value = min(req.value, board_mapping.get_max_pwm_value())
-        asyncio.run(set_pin_mode_analog_output(board, pin))
-        asyncio.run(asyncio.sleep(0.001))
-        asyncio.run(analog_write(board, pin, capped_value))
+        capped_value = min(req.value, MAX_PWM)
+        await set_pin_mode_analog_output(board, pin)
+        await analog_write(board, pin, capped_value)
     if req.type == "digital":
-        asyncio.run(board.set_pin_mode_digital_output(pin))
-        asyncio.run(asyncio.sleep(0.001))
-        asyncio.run(board.digital_write(pin, req.value))
-    return SetPinValueResponse(True)
+        await board.set_pin_mode_digital_output(pin)
+        await board.digital_write(pin, req.value)
+    return SET_PIN_VALUE_OK
 
 
 # Initialize the actuators. Each actuator will become a service
-# which can be called.
-def actuators(loop, board, device):
-    servers = []
+# which can be called. The returned coroutines only do the setup,
+# the services run in their own tasks.
+def actuators(loop, board, device, params):
+    global led_pin
+    tasks = []
 
-    if rospy.has_param("/mirte/oled"):
-        oleds = rospy.get_param("/mirte/oled")
+    if "oled" in params:
+        oleds = params["oled"]
         oleds = {k: v for k, v in oleds.items() if v["device"] == device}
         oled_id = 0
         for oled in oleds:
@@ -882,55 +1040,52 @@ def actuators(loop, board, device):
                 128, 64, board, oleds[oled], port=oled_id, loop=loop
             )  # get_pin_numbers(oleds[oled]))
             oled_id = oled_id + 1
-            servers.append(loop.create_task(oled_obj.start()))
+            tasks.append(oled_obj.start())
 
     # TODO: support multiple leds
-    if rospy.has_param("/mirte/led"):
-        led = rospy.get_param("/mirte/led")
-        loop.run_until_complete(
-            set_pin_mode_analog_output(board, get_pin_numbers(led)["pin"])
-        )
+    if "led" in params:
+        led_pin = get_pin_numbers(params["led"])["pin"]
+        tasks.append(set_pin_mode_analog_output(board, led_pin))
         server = aiorospy.AsyncService(
             "/mirte/set_led_value", SetLEDValue, handle_set_led_value
         )
-        servers.append(loop.create_task(server.start()))
+        start_server(loop, server.start(), "/mirte/set_led_value")
 
-    if rospy.has_param("/mirte/motor"):
-        motors = rospy.get_param("/mirte/motor")
+    if "motor" in params:
+        motors = params["motor"]
         motors = {k: v for k, v in motors.items() if v["device"] == device}
         for motor in motors:
-            motor_obj = {}
-            if motors[motor]["type"] == "ddp":
-                motor_obj = DDPMotor(board, motors[motor])
-            elif motors[motor]["type"] == "dp":
-                motor_obj = DPMotor(board, motors[motor])
-            elif motors[motor]["type"] == "pp":
-                motor_obj = PPMotor(board, motors[motor])
-            else:
+            motor_class = MOTOR_CLASSES.get(motors[motor]["type"])
+            if motor_class is None:
                 rospy.loginfo("Unsupported motor interface (ddp, dp, or pp)")
-            servers.append(loop.create_task(motor_obj.start()))
+                continue
+            motor_obj = motor_class(board, motors[motor], loop)
+            tasks.append(motor_obj.start())
 
-    if rospy.has_param("/mirte/servo"):
-        servos = rospy.get_param("/mirte/servo")
+    if "servo" in params:
+        servos = params["servo"]
         servos = {k: v for k, v in servos.items() if v["device"] == device}
         for servo in servos:
             servo = Servo(board, servos[servo])
-            servers.append(loop.create_task(servo.start()))
+            tasks.append(servo.start())
 
     # Set a raw pin value
-    server = rospy.Service("/mirte/set_pin_value", SetPinValue, handle_set_pin_value)
+    server = aiorospy.AsyncService(
+        "/mirte/set_pin_value", SetPinValue, handle_set_pin_value
+    )
+    start_server(loop, server.start(), "/mirte/set_pin_value")
 
-    return servers
+    return tasks
 
 
 # Initialize all sensors based on their definition in ROS param
 # server. For each sensor a topic is created which publishes
 # the data.
-def sensors(loop, board, device):
+def sensors(loop, board, device, params):
     tasks = []
     max_freq = 30
-    if rospy.has_param("/mirte/device/mirte/max_frequency"):
-        max_freq = rospy.get_param("/mirte/device/mirte/max_frequency")
+    if "max_frequency" in params["device"]["mirte"]:
+        max_freq = params["device"]["mirte"]["max_frequency"]
 
     # For now, we need to set the analog scan interval to teh max_freq. When we set
     # this to 0, we do get the updates from telemetrix as fast as possible. In that
@@ -939,89 +1094,91 @@ def sensors(loop, board, device):
     # nest_asyncio icw rospy services.
     # Maybe there is a better solution for this, to make sure that we get the
     # data here asap.
-    if board_mapping.get_mcu() == "pico":
-        if max_freq <= 1:
-            tasks.append(loop.create_task(board.set_scan_delay(1)))
-        else:
-            try:
-                tasks.append(
-                    loop.create_task(board.set_scan_delay(int(1000.0 / max_freq)))
-                )
-            except:
-                print("failed scan delay")
-                pass
+    # The max_frequency can be a float, but telemetrix needs ints.
+    if IS_PICO:
+        # The pico scan delay is in ms and needs to be at least 1
+        delay_ms = 1
+        if max_freq > 1:
+            delay_ms = max(1, int(1000 // max_freq))
+        tasks.append(set_scan_delay(board, delay_ms))
     else:
-        if max_freq <= 0:
-            tasks.append(loop.create_task(board.set_analog_scan_interval(0)))
-        else:
-            tasks.append(
-                loop.create_task(board.set_analog_scan_interval(int(1000.0 / max_freq)))
-            )
-
-    # initialze distance sensors
-    if rospy.has_param("/mirte/distance"):
-        distance_sensors = rospy.get_param("/mirte/distance")
-        distance_sensors = {
-            k: v for k, v in distance_sensors.items() if v["device"] == device
-        }
-        for sensor in distance_sensors:
-            distance_sensors[sensor]["max_frequency"] = max_freq
-            distance_publisher = rospy.Publisher(
-                "/mirte/" + sensor, Range, queue_size=1, latch=True
-            )
-            monitor = DistanceSensorMonitor(board, distance_sensors[sensor])
-            tasks.append(loop.create_task(monitor.start()))
+        interval_ms = 0
+        if max_freq > 0:
+            interval_ms = int(1000 // max_freq)
+        tasks.append(board.set_analog_scan_interval(interval_ms))
 
     # Initialize intensity sensors
-    if rospy.has_param("/mirte/intensity"):
-        intensity_sensors = rospy.get_param("/mirte/intensity")
+    if "intensity" in params:
+        intensity_sensors = params["intensity"]
         intensity_sensors = {
             k: v for k, v in intensity_sensors.items() if v["device"] == device
         }
         for sensor in intensity_sensors:
             intensity_sensors[sensor]["max_frequency"] = max_freq
-            if "analog" in get_pin_numbers(intensity_sensors[sensor]):
+            pins = get_pin_numbers(intensity_sensors[sensor])
+            if "analog" in pins:
                 monitor = AnalogIntensitySensorMonitor(board, intensity_sensors[sensor])
-                tasks.append(loop.create_task(monitor.start()))
-            if "digital" in get_pin_numbers(intensity_sensors[sensor]):
+                tasks.append(monitor.start())
+            if "digital" in pins:
                 monitor = DigitalIntensitySensorMonitor(
                     board, intensity_sensors[sensor]
                 )
-                tasks.append(loop.create_task(monitor.start()))
-
-    # Initialize keypad sensors
-    if rospy.has_param("/mirte/keypad"):
-        keypad_sensors = rospy.get_param("/mirte/keypad")
-        keypad_sensors = {
-            k: v for k, v in keypad_sensors.items() if v["device"] == device
+                tasks.append(monitor.start())
+
+    # Initialize the sensors that have a single monitor per sensor
+    for sensor_type, monitor_class in SENSOR_MONITORS.items():
+        sensors_of_type = {
+            k: v
+            for k, v in params.get(sensor_type, {}).items()
+            if v["device"] == device
         }
-        for sensor in keypad_sensors:
-            keypad_sensors[sensor]["max_frequency"] = max_freq
-            monitor = KeypadMonitor(board, keypad_sensors[sensor])
-            tasks.append(loop.create_task(monitor.start()))
-
-    # Initialize encoder sensors
-    if rospy.has_param("/mirte/encoder"):
-        encoder_sensors = rospy.get_param("/mirte/encoder")
-        encoder_sensors = {
-            k: v for k, v in encoder_sensors.items() if v["device"] == device
-        }
-        for sensor in encoder_sensors:
-            monitor = EncoderSensorMonitor(board, encoder_sensors[sensor])
-            tasks.append(loop.create_task(monitor.start()))
-            # encoder sensors do not need a max_frequency. They are interrupts on
-            # on the mcu side.
+        for sensor in sensors_of_type.values():
+            # NOTE: encoder sensors ignore the max_frequency. They are
+            # interrupts on the mcu side.
+            sensor["max_frequency"] = max_freq
+            monitor = monitor_class(board, sensor)
+            tasks.append(monitor.start())
 
     # Get a raw pin value
     # TODO: this still needs to be tested. We are waiting on an implementation of ananlog_read()
     # on the telemetrix side
-    rospy.Service("/mirte/get_pin_value", GetPinValue, handle_get_pin_value)
-    # server = aiorospy.AsyncService('/mirte/get_pin_value', GetPinValue, handle_get_pin_value)
-    # tasks.append(loop.create_task(server.start()))
+    server = aiorospy.AsyncService(
+        "/mirte/get_pin_value", GetPinValue, handle_get_pin_value
+    )
+    start_server(loop, server.start(), "/mirte/get_pin_value")
 
     return tasks
 
 
+# Run a one-shot startup task, reporting instead of raising its
+# exception so a failing sensor or actuator does not stop the others
+# from starting.
+async def run_startup_task(task):
+    try:
+        await task
+    except Exception as e:
+        rospy.logerr("Startup task failed: %r", e)
+
+
+# Long running servers (services and subscribers) run in their own
+# task. The loop only keeps weak references to its tasks, so keep
+# them here until they are done.
+server_tasks = set()
+
+
+async def run_server(server, name):
+    try:
+        await server
+    except Exception as e:
+        rospy.logerr("Server %s failed: %r", name, e)
+
+
+def start_server(loop, server, name):
+    task = loop.create_task(run_server(server, name))
+    server_tasks.add(task)
+    task.add_done_callback(server_tasks.discard)
+
+
 # Shutdown procedure
 closing = False
 
@@ -1034,20 +1191,31 @@ async def shutdown(loop, board):
     if not closing:
         closing = True
         await board.shutdown()
+        print("Telemetrix shutdown nicely")
+        rospy.signal_shutdown(0)
+
+        # Cancel and wait for the other tasks (services, subscribers)
+        # instead of blocking the loop with a sleep
+        tasks = asyncio.all_tasks(loop) - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
         # Stop the asyncio loop
         loop.stop()
-        print("Telemetrix shutdown nicely")
-        rospy.signal_shutdown(0)
-        time.sleep(1)
         exit(0)
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     loop = asyncio.new_event_loop()
+    # Make this the current loop, so the actuators and sensors
+    # created below schedule their work on it.
+    asyncio.set_event_loop(loop)
 
     # Initialize the telemetrix board
-    if board_mapping.get_mcu() == "pico":
+    if IS_PICO:
         board = tmx_pico_aio.TmxPicoAio(
             allow_i2c_errors=True, loop=loop, autostart=False
         )
@@ -1058,10 +1226,14 @@ if __name__ == "__main__":
     # Catch signals to exit properly
     # We need to do it this way instead of usgin the try/catch
     # as in the telemetrix examples
+    # Only start the shutdown once, also when signals are escalated
+    def signal_handler():
+        if not closing:
+            loop.create_task(shutdown(loop, board))
+
     signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
     for s in signals:
-        l = lambda loop=loop, board=board: asyncio.ensure_future(shutdown(loop, board))
-        loop.add_signal_handler(s, l)
+        loop.add_signal_handler(s, signal_handler)
 
     # Initialize the ROS node as anonymous since there
     # should only be one instnace running.
@@ -1074,13 +1246,20 @@ if __name__ == "__main__":
     l = lambda pid=os.getpid(), sig=signal.SIGINT: os.kill(pid, sig)
     rospy.on_shutdown(l)
 
+    # Get all settings at once instead of a parameter server
+    # request for every type of sensor and actuator
+    params = rospy.get_param("/mirte", {})
+
     # Start all tasks for sensors and actuators
     device = "mirte"
-    sensor_tasks = sensors(loop, board, device)
-    actuator_tasks = actuators(loop, board, device)
+    sensor_tasks = sensors(loop, board, device, params)
+    actuator_tasks = actuators(loop, board, device, params)
+    # These are the setup coroutines, gather schedules them all at once.
+    # The services and subscribers were started as their own tasks.
     all_tasks = sensor_tasks + actuator_tasks
-    for task in all_tasks:
-        loop.run_until_complete(task)
+    loop.run_until_complete(
+        asyncio.gather(*(run_startup_task(task) for task in all_tasks))
+    )
 
     # Is equivalent to rospy.spin() in a sense that this
     # will just keep the node running only in a asyncio